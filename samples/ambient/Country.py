@@ -1,7 +1,14 @@
 import os
-from osgeo import ogr
+import functools
 import geopandas as gpd
 
+
+@functools.lru_cache(maxsize=None)
+def _load_shp(path:str):
+  """Read a shapefile only once per path, sharing the GeoDataFrame among instances"""
+  return gpd.read_file(path)
+
+
 # Fazer Composição com continente no futuro
 class Country:
   def __init__(self, shapefiles_folder:str):
@@ -18,60 +25,40 @@ class Country:
     self._brasil_municipos_path = os.path.join(shapefile_brasi_municipio_folder, 'BRA_adm2.shp')
     self._brasil_distritos_path = os.path.join(shapefile_brasi_distrito_folder, 'BRA_adm3.shp')
 
-    # GeoDataFrame
-    self._brasil_pais = gpd.read_file(self._brasil_pais_path)
-    self._brasil_estados = gpd.read_file(self._brasil_estados_path)
-    self._brasil_municipos = gpd.read_file(self._brasil_municipos_path)
-    self._brasil_distritos = gpd.read_file(self._brasil_distritos_path)
+    # GeoDataFrame. Loaded only when their getter is called for the first time
+    self._brasil_pais = None
+    self._brasil_estados = None
+    self._brasil_municipos = None
+    self._brasil_distritos = None
   
   def get_brasil_pais_gdf(self):
+    if self._brasil_pais is None:
+      self._brasil_pais = _load_shp(self._brasil_pais_path)
     return self._brasil_pais
 
   def get_brasil_estados_gdf(self):
+    if self._brasil_estados is None:
+      self._brasil_estados = _load_shp(self._brasil_estados_path)
     return self._brasil_estados
 
   def get_brasil_municipos_gdf(self):
+    if self._brasil_municipos is None:
+      self._brasil_municipos = _load_shp(self._brasil_municipos_path)
     return self._brasil_municipos
 
   def get_brasil_distritos_gdf(self):
+    if self._brasil_distritos is None:
+      self._brasil_distritos = _load_shp(self._brasil_distritos_path)
     return self._brasil_distritos
 
   def get_df_only_with_inside_country_points(self,df,name_index:str='NAME_ISO',country_index:str='COUNTRY',lat_index:str='LATITUDE',lon_index:str='LONGITUDE'):
-    # open shapefile containing country polygons
-    #filename = '/content/drive/My Drive/TFC_MatheusSasso/Coolabs/Data/Shapefiles_World/TM_WORLD_BORDERS-0.3.shp'
-    filename = self._brasil_pais_path
-    drv = ogr.GetDriverByName('ESRI Shapefile')                     # set up driver object to read/write shapefiles
-    shapefile = drv.Open(filename) # open shapefile
-    layer = shapefile.GetLayer(0)                                   # create layer object for shapefile
-    # determine indices of relevant columns
-    nameIndex = layer.GetLayerDefn().GetFieldIndex(name_index)       # index of column with country names in shapefile 
-    countryIndex = df.columns.get_loc(country_index)       # index of country name column in observation table                                                            
-    latIndex = df.columns.get_loc(lat_index)               # index of lat column in observation table
-    lonIndex = df.columns.get_loc(lon_index)               # index of lon column in observation table
-
-    # set up list in which we will store the results of looking up the containing country for each row
-    geocodingResults = []  
-
-    # itertuples is used to efficiently loop through the rows of the data frame
-    for row in df.itertuples(index=False):  
+    # spatial join between the occurrence points and the country polygons
+    # the points carry only their position as index, so the result does not depend on df having a unique index
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(df[lon_index].to_numpy(), df[lat_index].to_numpy()), crs='EPSG:4326')
+    joined = gpd.sjoin(points, self.get_brasil_pais_gdf()[['geometry', name_index]], how='left', op='within')
+    joined = joined[~joined.index.duplicated(keep='first')]  # a point on a shared border may match more than one polygon
 
-        # create a new OGR point object with lon and lat coordinates from current row 
-        pt = ogr.Geometry(ogr.wkbPoint)                    
-        pt.SetPoint_2D(0, row[lonIndex], row[latIndex] )  
-
-        # apply spatial filter that will give us polygons that intersect our point
-        layer.SetSpatialFilter(pt)                         
-
-        country = "UNKNOWN"           # variable for storing the country's name
-
-        # check whether there's exactly one feature selected, if get country name of that feature
-        if layer.GetFeatureCount() == 1:                   
-            country = layer.GetNextFeature().GetFieldAsString(nameIndex).title()
-        
-        # add country name to result list
-        geocodingResults.append(country)                   
-    
-    df['country_geocoding'] = geocodingResults  # add geocoding results as new column
+    df['country_geocoding'] = joined[name_index].reindex(points.index).fillna('UNKNOWN').str.title().to_numpy()  # add geocoding results as new column
 
     df = df [(df.country_geocoding == df.COUNTRY)|(df.country_geocoding == 'Brazil')]
     return df
\ No newline at end of file
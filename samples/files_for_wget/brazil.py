@@ -1,5 +1,5 @@
 import os
-from osgeo import ogr
+import functools
 from shapely import wkt
 import geopandas as gpd
 import matplotlib.pyplot as plt
@@ -7,6 +7,12 @@ import pandas as pd
 from typing import Tuple
 
 
+@functools.lru_cache(maxsize=None)
+def _load_shp(path:str):
+  """Read a shapefile only once per path, sharing the GeoDataFrame among instances"""
+  return gpd.read_file(path)
+
+
 class Brazil:
   """
   This class models a country on the shapefile format on different detail levels
@@ -71,27 +77,35 @@ class Brazil:
     self._brazil_city_level_path = os.path.join(brazil_city_level_folder, 'BRA_adm2.shp')
     self._brazil_district_level_path = os.path.join(brazil_district_level_folder, 'BRA_adm3.shp')
 
-    # GeoDataFrame
-    self._brazil_country_level_gpd = gpd.read_file(self._brazil_country_level_path)
-    self._brazil_state_level_gpd = gpd.read_file(self._brazil_state_level_path)
-    self._brazil_city_level_gpd = gpd.read_file(self._brazil_city_level_path)
-    self._brazil_district_level_gpd = gpd.read_file(self._brazil_district_level_path)
+    # GeoDataFrame. Loaded only when their getter is called for the first time
+    self._brazil_country_level_gpd = None
+    self._brazil_state_level_gpd = None
+    self._brazil_city_level_gpd = None
+    self._brazil_district_level_gpd = None
 
 
   def get_country_level_gdf(self):
     """Construct geopandas dataframe for brazilian territory as country"""
+    if self._brazil_country_level_gpd is None:
+      self._brazil_country_level_gpd = _load_shp(self._brazil_country_level_path)
     return self._brazil_country_level_gpd
 
   def get_state_level_gdf(self):
     """Construct geopandas dataframe for brazilian territory as states"""
+    if self._brazil_state_level_gpd is None:
+      self._brazil_state_level_gpd = _load_shp(self._brazil_state_level_path)
     return self._brazil_state_level_gpd
 
   def get_city_level_gdf(self):
     """Construct geopandas dataframe for brazilian territory as cities"""
+    if self._brazil_city_level_gpd is None:
+      self._brazil_city_level_gpd = _load_shp(self._brazil_city_level_path)
     return self._brazil_city_level_gpd
 
   def get_district_level_gdf(self):
     """Construct geopandas dataframe for brazilian territory as disrticts"""
+    if self._brazil_district_level_gpd is None:
+      self._brazil_district_level_gpd = _load_shp(self._brazil_district_level_path)
     return self._brazil_district_level_gpd
 
   def get_df_only_with_inside_country_points(self,df,name_index:str='NAME_ISO',country_index:str='COUNTRY',lat_index:str='LATITUDE',lon_index:str='LONGITUDE'):
@@ -112,49 +126,22 @@ class Brazil:
         Column with longitude information
     """
 
-    # 1 --> Open shapefile containing country polygons
-    filename = self._brazil_country_level_path
-    drv = ogr.GetDriverByName('ESRI Shapefile')                # set up driver object to read/write shapefiles        
-    shapefile = drv.Open(filename)                             # open shapefile 
-    layer = shapefile.GetLayer(0)                              # create layer object for shapefile                               
-    
-    #2 --> Determine indices of relevant columns
-    nameIndex = layer.GetLayerDefn().GetFieldIndex(name_index) # index of column with country names in shapefile 
-    countryIndex = df.columns.get_loc(country_index)           # index of country name column in observation table                                                            
-    latIndex = df.columns.get_loc(lat_index)                   # index of lat column in observation table
-    lonIndex = df.columns.get_loc(lon_index)                   # index of lon column in observation table
-
-    #3 --> Countries Check.
-    geocodingResults = []  #Set up list in which we will store the results of looking up the containing country for each row
-
-    # itertuples is used to efficiently loop through the rows of the data frame
-    for row in df.itertuples(index=False):  
-
-        # create a new OGR point object with lon and lat coordinates from current row 
-        pt = ogr.Geometry(ogr.wkbPoint)                    
-        pt.SetPoint_2D(0, row[lonIndex], row[latIndex] )  
-
-        # apply spatial filter that will give us polygons that intersect our point
-        layer.SetSpatialFilter(pt)                         
-
-        country = "UNKNOWN"# variable for storing the country's name
-
-        # check whether there's exactly one feature selected, if get country name of that feature
-        if layer.GetFeatureCount() == 1:                   
-            country = layer.GetNextFeature().GetFieldAsString(nameIndex).title()
-        
-        # add country name to result list
-        geocodingResults.append(country)                   
-    
-    df['country_geocoding'] = geocodingResults  # add geocoding results as new column
+    # 1 --> Limits Check. Cheap bounding box filter so only the remaining points go through the point in polygon test
+    lon = df[lon_index].to_numpy(dtype=float)
+    lat = df[lat_index].to_numpy(dtype=float)
+    inside_limits = (lon>=self.x_min_limit) & (lon<=self.x_max_limit) & (lat>=self.y_min_limit) & (lat<=self.y_max_limit)
+    df = df.loc[inside_limits]
+    lon, lat = lon[inside_limits], lat[inside_limits]
+
+    #2 --> Countries Check. Spatial join between the occurrence points and the country polygons
+    # the points carry only their position as index, so the result does not depend on df having a unique index
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lon, lat), crs='EPSG:4326')
+    joined = gpd.sjoin(points, self.get_country_level_gdf()[['geometry', name_index]], how='left', op='within')
+    joined = joined[~joined.index.duplicated(keep='first')]  # a point on a shared border may match more than one polygon
+    geocoding = joined[name_index].reindex(points.index).fillna('UNKNOWN').str.title().to_numpy()
+
+    df = df.assign(country_geocoding=geocoding)  # add geocoding results as new column
     df = df [(df.country_geocoding == df.COUNTRY)|(df.country_geocoding == 'Brazil')]
-
-
-    #4 --> Limits Check.
-    df = df[df['LONGITUDE']>=self.x_min_limit]
-    df = df[df['LONGITUDE']<=self.x_max_limit]
-    df = df[df['LATITUDE']>=self.y_min_limit]
-    df = df[df['LATITUDE']<=self.y_max_limit]
     return df
 
 
@@ -166,13 +153,13 @@ class Brazil:
                               
     fig, ax = plt.subplots(figsize=(10, 10))
 
-    self._brazil_country_level_gpd.plot(ax=ax, facecolor='gray')
+    self.get_country_level_gdf().plot(ax=ax, facecolor='gray')
 
 
 
     if ".csv" in species_presences_path:
       df_species_presences = pd.read_csv(species_presences_path)
-      gdf_species_presences = gpd.GeoDataFrame(df_species_presences, geometry=gpd.points_from_xy(df_species_presences.LONGITUDE, df_species_presences.LATITUDE),crs='epsg:4326')
+      gdf_species_presences = gpd.GeoDataFrame(df_species_presences, geometry=gpd.points_from_xy(df_species_presences['LONGITUDE'].to_numpy(), df_species_presences['LATITUDE'].to_numpy(), crs='epsg:4326'))
       # df_species_presences['geometry'] = df_species_presences['geometry'].apply(wkt.loads)
       # gdf_species_presences = gpd.GeoDataFrame(df_species_presences, crs='epsg:4326')
     elif ".shp" in species_presences_path:
@@ -182,7 +169,7 @@ class Brazil:
     if species_absences_path:
       if ".csv" in species_absences_path:
         df_species_absences = pd.read_csv(species_absences_path)
-        gdf_species_absences = gpd.GeoDataFrame(df_species_absences, geometry=gpd.points_from_xy(df_species_absences.LONGITUDE, df_species_absences.LATITUDE),crs='epsg:4326')
+        gdf_species_absences = gpd.GeoDataFrame(df_species_absences, geometry=gpd.points_from_xy(df_species_absences['LONGITUDE'].to_numpy(), df_species_absences['LATITUDE'].to_numpy(), crs='epsg:4326'))
       elif ".shp" in species_absences_path:
         gdf_species_absences = gpd.read_file(species_absences_path)
       gdf_species_absences.plot(ax=ax, color='red', markersize=5,label="absences")
@@ -7,6 +7,7 @@ from sklearn import svm, metrics
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import KFold
+from joblib import Parallel, delayed
 # from raster_standards import Raster_Standards
 # from utils import Utils
 import rasterio
@@ -29,6 +30,12 @@ class OneClassSVMModel:
       if ‘auto’, uses 1 / n_features.
   seed : object
     Aleatory seed
+  solver : str
+    'libsvm' for the exact OneClassSVM or 'sgd' for a Nystroem kernel approximation followed by SGDOneClassSVM, that scales linearly with the number of points
+  n_components : int
+    Number of Nystroem components used when solver='sgd'
+  n_jobs : int
+    Number of threads used to evaluate the decision function over the land pixels (-1 for all cores)
   raster_standards : object
     Raster standards object
   utils_methods : object
@@ -42,7 +49,7 @@ class OneClassSVMModel:
     Parameters
     ----------
     hyperparams : Dict
-        Set of hyperparameters for the model(nu,kernel,gamma,seed)
+        Set of hyperparameters for the model(nu,kernel,gamma,seed and optionally solver,n_components,n_jobs)
     raster_standards : Object
         Raster standards object
     utils_methods : Object
@@ -57,6 +64,9 @@ class OneClassSVMModel:
     self.kernel = hyperparams["kernel"]
     self.gamma = hyperparams["gamma"]
     self.seed = hyperparams["seed"]
+    self.solver = hyperparams.get("solver","libsvm")
+    self.n_components = hyperparams.get("n_components",300)
+    self.n_jobs = hyperparams.get("n_jobs",-1)
     
     #-------------- 
     self.raster_standards = raster_standards
@@ -65,38 +75,67 @@ class OneClassSVMModel:
     np.random.seed(self.seed)
 
 
+  def _standardize(self,data,global_mean,global_std,out=None):
+    """ Standardize data with the global statistics in a single pass. Variables with std=0 and NaN values are set to 0. If out is given the result is written on it """
+    safe_std = np.where(global_std > 0, global_std, np.inf) #dividing by inf gives 0 where NaN values would come from std=0
+    standardized = np.subtract(data, global_mean, out=out, dtype=np.float32)
+    np.divide(standardized, safe_std, out=standardized)
+    np.nan_to_num(standardized, copy=False, nan=0.0) #NaN pixels or NaN band means would make decision_function raise
+    return standardized
+
+  def _resolve_gamma(self,data):
+    """ Translate 'scale' and 'auto' gammas to the number OneClassSVM would use, since Nystroem only accepts numbers """
+    if self.gamma == 'scale':
+      var = data.var()
+      return 1.0 / (data.shape[1] * var) if var != 0 else 1.0 # same fallback scikit-learn uses for constant data
+    if self.gamma == 'auto':
+      return 1.0 / data.shape[1]
+    return self.gamma
+
   def fit(self,species_bunch,global_mean,global_std):
     """ Fitting data with normalized data """
-    train_cover_std = (species_bunch['raster_data_train'] - global_mean) / global_std
-    train_cover_std[np.isnan(train_cover_std)] = 0 #Nan values comes from std=0 in some variable
-    clf = svm.OneClassSVM(nu=self.nu, kernel=self.kernel, gamma=self.gamma)
+    train_cover_std = self._standardize(species_bunch['raster_data_train'],global_mean,global_std)
+    if self.solver == "sgd":
+      # imported only here, SGDOneClassSVM needs scikit-learn 1.0 or newer
+      from sklearn.kernel_approximation import Nystroem
+      from sklearn.linear_model import SGDOneClassSVM
+      from sklearn.pipeline import Pipeline
+      clf = Pipeline([('kernel_map', Nystroem(kernel=self.kernel, gamma=self._resolve_gamma(train_cover_std), n_components=self.n_components, random_state=self.seed)),
+                      ('ocsvm', SGDOneClassSVM(nu=self.nu, random_state=self.seed))])
+    else:
+      clf = svm.OneClassSVM(nu=self.nu, kernel=self.kernel, gamma=self.gamma)
     clf.fit(train_cover_std)
     return clf
   
-  def predict_land(self,stacked_raster_coverages,clf,global_mean,global_std):
-    """ Predict adaptability for every valid point on the map """
+  def _extract_land_coverages(self,stacked_raster_coverages,global_mean):
+    """ Extract the (land_pixels,bands) matrix from the stacked coverages, with no data values replaced by the band mean """
 
-    stacked_raster_coverages_shape = stacked_raster_coverages.shape
-    print('Shape stacked_raster_coverages: ',stacked_raster_coverages_shape)
+    print('Shape stacked_raster_coverages: ',stacked_raster_coverages.shape)
 
     # Extracting coverages land
-    idx = np.where(self.land_reference == self.raster_standards.positive_mask_val) # Coordenadas X e Y em duas tuplas de onde a condição se satifaz (array(),array())
-    
+    land_idx = np.where(self.land_reference == self.raster_standards.positive_mask_val) # Coordenadas X e Y em duas tuplas de onde a condição se satifaz (array(),array())
+    raster_coverages_land = stacked_raster_coverages[:, land_idx[0],land_idx[1]].T
+    no_data_mask = raster_coverages_land <= self.raster_standards.no_data_val
+    np.copyto(raster_coverages_land, global_mean[np.newaxis,:], where=no_data_mask) # no data values receive the band mean
+    del no_data_mask
+    return raster_coverages_land,land_idx
+
+  def _batched_decision_function(self,clf,data,batch_size:int=500000):
+    """ Evaluate the decision function by row batches on parallel threads, bounding the memory of each kernel evaluation """
+    n_batches = max(1, int(np.ceil(data.shape[0] / batch_size)))
+    batches = np.array_split(data, n_batches)
+    return np.concatenate(Parallel(n_jobs=self.n_jobs, backend='threading')(delayed(clf.decision_function)(batch) for batch in batches))
+
+  def predict_land(self,scaled_coverages_land,land_idx,clf):
+    """ Predict adaptability for every valid point on the map """
+
     #Performing Predictions
-    raster_coverages_land = stacked_raster_coverages[:, idx[0],idx[1]].T
-    for k in range(raster_coverages_land.shape[1]):
-      raster_coverages_land[:,k][raster_coverages_land[:,k]<=self.raster_standards.no_data_val] = global_mean[k]
-      
-    scaled_coverages_land = (raster_coverages_land - global_mean) / global_std
-    del raster_coverages_land
-    scaled_coverages_land[np.isnan(scaled_coverages_land)] = 0
-    global_pred = clf.decision_function(scaled_coverages_land)
-    del scaled_coverages_land
+    global_pred = self._batched_decision_function(clf,scaled_coverages_land)
 
     #Setting Spatial Predictions
-    Z = np.ones((stacked_raster_coverages_shape[1], stacked_raster_coverages_shape[2]), dtype=np.float64)#cria um array de uns do tamanho das dimensões do brasil
+    Z = np.ones(self.land_reference.shape, dtype=np.float64)#cria um array de uns do tamanho das dimensões do brasil
     Z *= global_pred.min() #Miltiplica ele pelo mínimo das predições [valor muito baixo ou zero]
-    Z[idx[0], idx[1]] = global_pred #atribui o valor de pred para lugares onde não são zero
+    Z[land_idx[0], land_idx[1]] = global_pred #atribui o valor de pred para lugares onde não são zero
     del global_pred
 
 
@@ -108,8 +147,7 @@ class OneClassSVMModel:
   def predict_test_occurences(self,species_bunch,clf,global_mean,global_std):
     """ Fitting adaptability only for test set data """
 
-    scaled_species_raster_test = (species_bunch['raster_data_test'] - global_mean) / global_std
-    scaled_species_raster_test[np.isnan(scaled_species_raster_test)] = 0
+    scaled_species_raster_test = self._standardize(species_bunch['raster_data_test'],global_mean,global_std)
     pred_test = clf.decision_function(scaled_species_raster_test)
     return pred_test
 
@@ -126,34 +164,30 @@ class OneClassSVMModel:
 
     #3 Retrieving raster stacked coverages data
     print("---------------------- Reading and stacking rasters ----------------------")
-    raster_coverages_list = []
-    for rasters_root_folder in rasters_root_folders_list:
-        raster_coverages = self.raster_standards.get_rasters_from_dir(rasters_root_folder)
-        raster_coverages_list.append(raster_coverages)
-        raster_coverages = None
-    stacked_raster_coverages = np.concatenate([x for x in raster_coverages_list], axis=0)
-    del raster_coverages_list
+    rasters_paths_list = [self.raster_standards.get_raster_paths_from_dir(rasters_root_folder) for rasters_root_folder in rasters_root_folders_list]
+    n_bands = sum(len(rasters_paths) for rasters_paths in rasters_paths_list)
+    stacked_raster_coverages = np.empty((n_bands,)+self.land_reference.shape, dtype=np.float32) # every raster shares the land reference grid
+    band_offset = 0
+    for rasters_root_folder,rasters_paths in zip(rasters_root_folders_list,rasters_paths_list):
+        self.raster_standards.get_rasters_from_dir(rasters_root_folder,out=stacked_raster_coverages[band_offset:band_offset+len(rasters_paths)])
+        band_offset += len(rasters_paths)
     print("Stack finished")
     
-    #4 Reshaping data
-    stacked_raster_coverages_copy = np.copy(stacked_raster_coverages)#(38,4923, 4942)
-    stacked_raster_coverages_copy = np.transpose(stacked_raster_coverages_copy,(1,2,0)) #(4923, 4942,38)
-    stacked_raster_coverages_copy = np.reshape(stacked_raster_coverages_copy,(-1,stacked_raster_coverages_copy.shape[2]))#(24329466,38)
-
-    #5 Taking Means and Stds
-    global_mean = np.zeros(shape=(0))
-    for i in range(stacked_raster_coverages_copy.shape[1]):
-      mean = np.mean(stacked_raster_coverages_copy[:,i][stacked_raster_coverages_copy[:,i]>self.raster_standards.no_data_val])
-      global_mean = np.append(global_mean, mean)
-    global_mean = np.float32(global_mean)
-    
-    global_std = np.zeros(shape=(0))
-    for i in range(stacked_raster_coverages_copy.shape[1]):
-      std = np.std(stacked_raster_coverages_copy[:,i][stacked_raster_coverages_copy[:,i]> self.raster_standards.no_data_val])
-      global_std = np.append(global_std, std)
-    global_std = np.float32(global_std)
-    
-    del stacked_raster_coverages_copy
+    #4 Taking Means and Stds for each band of the (bands,rows,cols) stack, ignoring no data values
+    n_bands = stacked_raster_coverages.shape[0]
+    global_mean = np.empty(n_bands, dtype=np.float32)
+    global_std = np.empty(n_bands, dtype=np.float32)
+    for b in range(n_bands):
+      band = stacked_raster_coverages[b]
+      valid_values = band[band > self.raster_standards.no_data_val]
+      global_mean[b] = valid_values.mean(dtype=np.float64)
+      global_std[b] = valid_values.std(dtype=np.float64)
+      del valid_values
+
+    #5 Extracting and scaling land coverages once, they are the same for every fold. Scaling is done in place to keep a single buffer
+    scaled_coverages_land,land_idx = self._extract_land_coverages(stacked_raster_coverages,global_mean)
+    del stacked_raster_coverages
+    self._standardize(scaled_coverages_land,global_mean,global_std,out=scaled_coverages_land)
   
     #6 reating kfolds object
     kf = KFold(n_splits=K,random_state=self.seed, shuffle=True)
@@ -180,7 +214,7 @@ class OneClassSVMModel:
       pred_test = self.predict_test_occurences(species_bunch,clf,global_mean,global_std)
 
       #predicting land values
-      Z = self.predict_land(stacked_raster_coverages,clf,global_mean,global_std)
+      Z = self.predict_land(scaled_coverages_land,land_idx,clf)
 
 
       #save Z
@@ -1,5 +1,6 @@
 from typing import List,Tuple
-import gc
+import os
+from concurrent.futures import ThreadPoolExecutor
 from sklearn.utils import Bunch
 import geopandas as gpd
 import rasterio
@@ -8,6 +9,10 @@ from rasterio.plot import show
 from rasterio.windows import Window
 from osgeo import gdal
 from matplotlib import pyplot
+try:
+  import pyogrio
+except ImportError:
+  pyogrio = None
 
 
 
@@ -23,9 +28,11 @@ class Raster_Information_Collector:
       Limit of iterations to correct no information points
   raster_standards : object
       Raster standards object
+  max_workers : int
+      Number of rasters read at the same time. Each one holds its array (up to a whole raster) in memory
   """
 
-  def __init__(self, output_dir:str,raster_standards,coorection_limit:int=10):
+  def __init__(self, output_dir:str,raster_standards,coorection_limit:int=10,max_workers:int=4):
       """
       Parameters
       ----------
@@ -35,119 +42,149 @@ class Raster_Information_Collector:
           Limit of iterations to correct no information points
       raster_standards : object
           Raster standards object
+      max_workers : int
+          Number of rasters read at the same time. Each thread holds the array it reads, a whole raster (~100 MB) when the points spread over most of the map, so memory grows with it
       """
 
+      # windowed reads, grid indexes and sampling come from the raster_standardsV2 Raster_Standards
+      missing = [name for name in ('get_grid_indexes','open_raster_standarized','sample_raster_cells','raster_cache_size','reference_raster') if not hasattr(raster_standards,name)]
+      if missing:
+        raise Exception(f"raster_standards must be a raster_standardsV2.Raster_Standards. The given object has no {', '.join(missing)}")
+
       self.output_dir = output_dir
       self.raster_standards = raster_standards
       self.coorection_limit = coorection_limit
-
-  def _treat_boarder_points(self,Long,Lat,ix,iy,raster_array,raster_occurrences_array):
-      "Repair problems on points very near to the the country boarders by getting nearest values on the center point direction"
-
-      for i,elem in enumerate(raster_occurrences_array):
-        if elem == -9999.0:
-          point_x,point_y = Long[i],Lat[i]
-          base_point_x,base_point_y = point_x.copy(),point_y.copy()
-          incx,incy = 0,0
-          k = 0
-          #walking coodinates in center map
-          while (elem==-9999.0 and k<self.coorection_limit):
-            if point_x >= self.raster_standards.x_center_point and  point_y >= self.raster_standards.y_center_point:
-              point_x -= self.raster_standards.resolution
-              point_y -= self.raster_standards.resolution
-              incx -= 1
-              incy -= 1
-            if point_x >= self.raster_standards.x_center_point and  point_y <= self.raster_standards.y_center_point:
-              point_x -= self.raster_standards.resolution
-              point_y += self.raster_standards.resolution
-              incx -= 1
-              incy += 1
-            if point_x <= self.raster_standards.x_center_point and  point_y <= self.raster_standards.y_center_point:
-              point_x += self.raster_standards.resolution
-              point_y += self.raster_standards.resolution
-              incx += 1
-              incy += 1
-            if point_x <= self.raster_standards.x_center_point and  point_y >= self.raster_standards.y_center_point:
-              point_x += self.raster_standards.resolution
-              point_y -= self.raster_standards.resolution
-              incx += 1
-              incy -= 1           
-
-            new_ix = ix[i]+incx
-            new_iy = iy[i]+incy
-
-            value = raster_array[-new_iy,new_ix].T
-            if value != -9999.0:
-              raster_occurrences_array[i] = value
-              elem = value
-              print(f"The raster coordniate info was changed from the point {(base_point_x,base_point_y)} to the point {(point_x,point_y)}")
-            k+=1
-      return raster_occurrences_array  
-
-  def _fill_peristent_no_data_values_with_mean(self,raster_occurrences_array):
-      """ For grids that still with empty value after the board points treatment, this function fill it with the mean value"""
-
-      mean_value = np.mean(raster_occurrences_array[[raster_occurrences_array!=-9999.0]])
-      for i,elem in enumerate(raster_occurrences_array):
-        if elem == -9999.0:
-          raster_occurrences_array[i] = mean_value
-      
+      self.max_workers = max_workers
+
+  def _repair_no_data_values(self,sign_x,sign_y,rows,cols,raster_shape,get_values,raster_occurrences_array):
+      """ Repair points very near to the country boarders by getting the nearest value, through get_values(rows,cols), on the center point direction. Points that still with no data receive the mean value"""
+
+      # each point walks diagonally in the map center direction, one cell per step
+      no_data = raster_occurrences_array == -9999.0
+      n_no_data = no_data.sum()
+
+      for k in range(1,self.coorection_limit+1):
+        idx = np.flatnonzero(no_data)
+        if idx.size == 0:
+          break
+        candidate_rows = np.clip(rows[idx]-sign_y[idx]*k, 0, raster_shape[0]-1) # rows grow southwards
+        candidate_cols = np.clip(cols[idx]+sign_x[idx]*k, 0, raster_shape[1]-1)
+        values = get_values(candidate_rows, candidate_cols)
+        found = values != -9999.0
+        raster_occurrences_array[idx[found]] = values[found]
+        no_data[idx[found]] = False
+
+      n_changed = n_no_data - no_data.sum()
+      if n_changed > 0:
+        print(f"The raster coordniate info of {n_changed} points was changed to a point closer to the map center")
+
+      # the same mask tells which points still with no data
+      if no_data.any() and not no_data.all():
+        raster_occurrences_array[no_data] = raster_occurrences_array[~no_data].mean()
       return raster_occurrences_array
 
-  def _update_coverages(self,species_name,coverage):
-      """ Treats if a new numpy array is created or if an existing one is updated"""
-      try:
-          with open(self.output_dir+'/'+species_name + '.npy', 'rb') as f:
-            numpy_raster_info = np.load(f)
-            coverage = np.concatenate((numpy_raster_info,coverage),axis=1)
-            with open(self.output_dir+'/'+species_name  + '.npy', 'wb') as f:
-              np.save(f, coverage)
-      except Exception as e:
-          print(e)
-          with open(self.output_dir+'/'+species_name + '.npy', 'wb') as f:
-            np.save(f, coverage)
-      print(species_name + ' successfully saved on the folder ' + self.output_dir + "with shape: " ,coverage.shape)
+  def _get_points_window(self,rows,cols,n_rows,n_cols):
+      """ Window around the points with room for the border treatment walk. None when it would cover most of the raster or there are no points"""
+      if rows.size == 0:
+        return None
+      row_start = max(int(rows.min())-self.coorection_limit, 0)
+      row_stop = min(int(rows.max())+self.coorection_limit+1, n_rows)
+      col_start = max(int(cols.min())-self.coorection_limit, 0)
+      col_stop = min(int(cols.max())+self.coorection_limit+1, n_cols)
+      if (row_stop-row_start)*(col_stop-col_start) > 0.5*n_rows*n_cols:
+        return None
+      return Window(col_off=col_start, row_off=row_start, width=col_stop-col_start, height=row_stop-row_start)
+
+  def _is_sparse(self,n_points,window,n_rows,n_cols):
+      """ True when the points are so few that sampling them touches much less blocks than reading the window"""
+      if self.raster_standards.raster_cache_size:
+        return False # cached rasters are already in memory
+      block_rows,block_cols = self.raster_standards.reference_raster.block_shapes[0]
+      area = n_rows*n_cols if window is None else window.width*window.height
+      return n_points*block_rows*block_cols < 0.1*area
+
+  def _coverages_path(self,species_name):
+      """ Path of the species numpy file"""
+      return self.output_dir+'/'+species_name + '.npy'
+
+  def _open_coverages(self,species_name,n_points,n_new_columns):
+      """ Allocates the species coverages on a temporary file, keeping the columns of an existing one. Returns the array and its first column to be filled"""
+      coverages_path = self._coverages_path(species_name)
+      n_previous_columns = 0
+      previous_coverage = None
+      if os.path.exists(coverages_path):
+          previous_coverage = np.load(coverages_path, mmap_mode='r')
+          if previous_coverage.shape[0] == n_points:
+            n_previous_columns = previous_coverage.shape[1]
+          else:
+            print(f"Existing coverages with shape {previous_coverage.shape} do not match the {n_points} points and will be overwritten")
+
+      coverage = np.lib.format.open_memmap(coverages_path + '.tmp', mode='w+', dtype=np.float32, shape=(n_points,n_previous_columns+n_new_columns))
+      if n_previous_columns:
+          coverage[:,:n_previous_columns] = previous_coverage
+      del previous_coverage
+      return coverage,n_previous_columns
+
+  def _extract_raster_occurrences(self,fp,window,rows,cols,sign_x,sign_y,sample_points):
+      """ Extract the values of one raster on the occurrence points, with the no data values treated. Sparse points are sampled instead of reading the raster"""
+
+      # Exctraction occurences from rasters
+      if sample_points:
+        raster = self.raster_standards.open_raster_standarized(fp)
+        raster_shape = (raster.height,raster.width)
+        get_values = lambda r,c: self.raster_standards.sample_raster_cells(raster,r,c)
+      else:
+        raster_array = self.raster_standards.get_raster_array(fp,window=window)
+        raster_shape = raster_array.shape
+        get_values = lambda r,c: raster_array[r,c]
+      raster_occurrences_array = get_values(rows, cols)
+      
+      #treating cases where points that should be inside country are outside and the ones that still with no data values
+      return self._repair_no_data_values(sign_x,sign_y,rows,cols,raster_shape,get_values,raster_occurrences_array)
 
   def save_coverges_to_numpy(self,specie_dir:str,species_name:str,root_raster_files_list:List[str]):
     """ Save all extracted to a numpy array"""
 
-    data = gpd.read_file(specie_dir)
-    coordinates = np.array((np.array(data['LATITUDE']),np.array(data['LONGITUDE']))).T
+    # only the coordinates attributes are needed, so pyogrio skips the geometries when available
+    if pyogrio is not None:
+      data = pyogrio.read_dataframe(specie_dir, columns=['LATITUDE','LONGITUDE'], read_geometry=False)
+    else:
+      data = gpd.read_file(specie_dir)
         
     # determine coverage values for each of the training & testing points
-    Long = coordinates[:,1]
-    Lat = coordinates[:,0]
-    ix = np.searchsorted(self.raster_standards.xgrid,Long)
-    iy = np.searchsorted(self.raster_standards.ygrid,Lat)
-
-    all_env_values_list = []
-    for i,fp in enumerate(root_raster_files_list):
-        
-        # Exctraction occurences from rasters
-        raster_array = self.raster_standards.get_raster_array(fp)
-        raster_occurrences_array = raster_array[-iy, ix].T
-        
-        #treating cases where points that should be inside country are outside
-        raster_occurrences_array = self._treat_boarder_points(Long,Lat,ix,iy,raster_array,raster_occurrences_array)
-        del raster_array
-
-        #tretaing cases that still with no data values
-        raster_occurrences_array= self._fill_peristent_no_data_values_with_mean(raster_occurrences_array)
-        
-        #selecting the env value on the occurrence position
-        all_env_values_list.append(raster_occurrences_array)
-
-        del raster_occurrences_array
-        gc.collect()
-
-    coverage= np.stack([value for value in all_env_values_list]).T
-    del ix
-    del iy
-    del all_env_values_list
-    gc.collect() 
-
-    self._update_coverages(species_name,coverage)
-    
-    del coverage
-    gc.collect()
-   
\ No newline at end of file
+    Long = data['LONGITUDE'].to_numpy(dtype=np.float64)
+    Lat = data['LATITUDE'].to_numpy(dtype=np.float64)
+    del data
+    ix,iy = self.raster_standards.get_grid_indexes(Long,Lat)
+
+    # raster rows are counted from the north while iy is counted from the south
+    n_rows,n_cols = len(self.raster_standards.ygrid),len(self.raster_standards.xgrid)
+    rows,cols = (-iy) % n_rows,ix
+
+    # only the window around the points is read from each raster, or just the points cells when they are sparse
+    window = self._get_points_window(rows,cols,n_rows,n_cols)
+    sample_points = len(Long) > 0 and self._is_sparse(len(Long),window,n_rows,n_cols)
+    if sample_points:
+        window = None
+    elif window is not None:
+        rows,cols = rows - window.row_off,cols - window.col_off
+
+    # direction of the border points walk, the same for every raster
+    sign_x = np.where(Long >= self.raster_standards.x_center_point, -1, 1).astype(np.int32)
+    sign_y = np.where(Lat >= self.raster_standards.y_center_point, -1, 1).astype(np.int32)
+
+    # every raster fills its own column of the (points,rasters) coverages written on disk. Rasters are read on parallel threads
+    coverage,first_column = self._open_coverages(species_name,len(Long),len(root_raster_files_list))
+    if len(Long) > 0: # without points there is nothing to read
+      with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+          raster_occurrences = executor.map(lambda fp: self._extract_raster_occurrences(fp,window,rows,cols,sign_x,sign_y,sample_points), root_raster_files_list)
+          for i,raster_occurrences_array in enumerate(raster_occurrences):
+              coverage[:,first_column+i] = raster_occurrences_array
+              del raster_occurrences_array
+
+    del ix,iy,rows,cols,sign_x,sign_y
+
+    coverage.flush()
+    print(species_name + ' successfully saved on the folder ' + self.output_dir + "with shape: " ,coverage.shape)
+    del coverage # releases the memory map before the file is moved
+    os.replace(self._coverages_path(species_name) + '.tmp', self._coverages_path(species_name))
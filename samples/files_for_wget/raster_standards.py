@@ -1,8 +1,10 @@
 from typing import List,Tuple
 import numpy as np
 import os
+import hashlib
 import rasterio
 from rasterio.enums import Resampling
+from rasterio.windows import Window
 
 
 class Raster_Standards:
@@ -64,15 +66,20 @@ class Raster_Standards:
       grids = self._construct_grids()
       self.xgrid = grids[0]
       self.ygrid = grids[1]
-      self.x_center_point = np.median(self.xgrid)
-      self.y_center_point = np.median(self.ygrid)
+      self.x_center_point = 0.5 * (self.xgrid[0] + self.xgrid[-1]) # grids are evenly spaced, so the median is the midpoint
+      self.y_center_point = 0.5 * (self.ygrid[0] + self.ygrid[-1])
 
   
 
   def _construct_grids(self):
       """Construct the map grid from the batch object"""
-      xgrid = np.arange(self.x_min_limit, self.x_max_limit, self.resolution)
-      ygrid = np.arange(self.y_min_limit, self.y_max_limit, self.resolution)
+      # Integer number of cells + linspace avoids the float drift arange has with steps like 1/120
+      nx = int(round((self.x_max_limit - self.x_min_limit) / self.resolution))
+      ny = int(round((self.y_max_limit - self.y_min_limit) / self.resolution))
+      xgrid = np.linspace(self.x_min_limit, self.x_max_limit, nx, endpoint=False)
+      ygrid = np.linspace(self.y_min_limit, self.y_max_limit, ny, endpoint=False)
+      xgrid.setflags(write=False) # the grids are shared by every caller and never change
+      ygrid.setflags(write=False)
       return (xgrid,ygrid)
 
 
@@ -104,11 +111,11 @@ class Raster_Standards:
         transform = raster_object.meta['transform']
       return data,transform
 
-  def get_window_from_extent(self,aff):
+  def _get_window_from_extent(self,aff):
     """ Get a portion form a raster array based on the country limits"""
     col_start, row_start = ~aff * (self.x_min_limit, self.y_max_limit)
     col_stop, row_stop = ~aff * (self.x_max_limit, self.y_min_limit)
-    return ((int(row_start), int(row_stop)), (int(col_start), int(col_stop)))
+    return Window(col_off=int(col_start), row_off=int(row_start), width=int(col_stop)-int(col_start), height=int(row_stop)-int(row_start))
 
   def _read_array_standarized(self,raster,raster_name):
       """ Performs verifications and standarizations for raster arrays """
@@ -133,7 +140,7 @@ class Raster_Standards:
         # raster = raster.to_crs(epsg=self.crs)
 
       #4 Extracting only the window from Raster Standars Object
-      raster_array = raster.read(1,window = self._get_window_from_extent(raster.meta['transform']))
+      raster_array = raster.read(1,window = self._get_window_from_extent(raster.meta['transform']),out_dtype=np.float32)
 
       #5 Resampling
       if not (round(self.resolution,5) == round(raster.meta['transform'][0],5)):
@@ -147,12 +154,12 @@ class Raster_Standards:
         # raster_array[raster_array==raster.nodata] = self.no_data_val
         print(f"The Raster no data value converted from EPSG {raster.nodata} to EPSG:{self.no_data_val}")
       else:
-        raster_array_final = np.copy(raster_array)
+        raster_array_final = raster_array
         del raster_array
 
 
       #7 Asserting that numpy array will be float32
-      raster_array_final = np.float32(raster_array_final)
+      raster_array_final = raster_array_final.astype(np.float32,copy=False)
       
       #8 Setting raster to none. The information that matters is the rater aray
       raster = None
@@ -160,11 +167,29 @@ class Raster_Standards:
       return raster_array_final
   
   def get_land_reference_array_mask(self,land_reference_path):
-      """ Returns the reference array mask conseidering scales and limits"""
+      """ Returns the reference array mask conseidering scales and limits. It is cached on a .npy file next to the raster, named after the limits and resolution, and memory mapped afterwards"""
+      settings = repr((self.x_min_limit,self.x_max_limit,self.y_min_limit,self.y_max_limit,self.resolution))
+      cache_path = os.path.splitext(land_reference_path)[0] + '_mask_' + hashlib.md5(settings.encode()).hexdigest()[:12] + '.npy'
+      if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(land_reference_path):
+        return np.load(cache_path, mmap_mode='r')
+
       raster = rasterio.open(land_reference_path)
       raster_array = raster.read(1,window = self._get_window_from_extent(raster.meta['transform']))
       raster_array,_ = self._reescale(raster_array,raster)
-      return raster_array
+
+      # the cache is written aside and moved into place, so an interrupted write never leaves a truncated file behind
+      tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+      try:
+        with open(tmp_path,'wb') as f:
+          np.save(f, raster_array)
+        os.replace(tmp_path, cache_path)
+      except OSError as e:
+        print(f"The land reference mask could not be cached on {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+        return raster_array
+      # the same read only memory map is returned whether the cache was hit or just written
+      return np.load(cache_path, mmap_mode='r')
 
   def get_raster_array(self,path,print_example = False):
       """ Returns a raster array with all the standarizations applied"""
@@ -174,22 +199,26 @@ class Raster_Standards:
       raster_array = self._read_array_standarized(raster,path.split("/")[-1])   
       return raster_array
     
-  def get_rasters_from_dir(self,dir_path):
-      """ Read all the .tif files on the standarized format and stack them"""
-      rasters = []
-      for (dirpath, dirnames, filenames) in os.walk(dir_path):
-        dir_files_paths_list = sorted([os.path.join(dir_path, fname) for fname in filenames])
-        for filepath,filename in zip(dir_files_paths_list,filenames):
-          if filename.endswith('.tif'):
-            raster_array  = self.get_raster_array(filepath)
-            rasters.append(raster_array) 
-            del raster_array
-        break
-      
-      result =  np.stack([value for value in rasters])
-      del rasters
-
-      return result
+  def get_raster_paths_from_dir(self,dir_path):
+      """ Returns the sorted paths of the .tif files on a directory"""
+      if not os.path.isdir(dir_path):
+        raise FileNotFoundError(f"Raster directory {dir_path} does not exist")
+      with os.scandir(dir_path) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith('.tif') and entry.is_file())
+
+  def get_rasters_from_dir(self,dir_path,out=None):
+      """ Read all the .tif files on the standarized format and stack them. If out is given the rasters are written straight into it"""
+      filepaths = self.get_raster_paths_from_dir(dir_path)
+      with rasterio.Env(GDAL_CACHEMAX=512):
+        for i,filepath in enumerate(filepaths):
+          raster_array  = self.get_raster_array(filepath)
+          if out is None:
+            # the first raster gives the shape shared by all of them, so the stack is allocated once
+            out = np.empty((len(filepaths),)+raster_array.shape, dtype=np.float32)
+          out[i] = raster_array
+          del raster_array
+
+      return out
 
   def get_land_reference_array_infos(self,country_mask_reference):
       """ Returns infos (raster_array,xgrid,ygrid) from a contry mask reference array"""
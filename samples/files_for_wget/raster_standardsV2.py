@@ -1,8 +1,12 @@
 from typing import List,Tuple
 import numpy as np
 import os
+import hashlib
+import threading
+from collections import OrderedDict
 import rasterio
 from rasterio.enums import Resampling
+from rasterio.windows import Window
 from rasterio.plot import show
 
 
@@ -41,6 +45,8 @@ class Raster_Standards:
       Center point X coordinate
   y_center_point : int
       Center point Y coordinate
+  raster_cache_size : int
+      Number of standarized raster arrays kept in memory between calls (0 disables the cache)
   """
 
   def __init__(self, raster_base_configs):
@@ -48,7 +54,7 @@ class Raster_Standards:
       Parameters
       ----------
       raster_base_configs : Dict
-          Configurations for raster Standards (resolution,crs,no_data_val,positive_mask_val,negative_mask_val and country_limits)
+          Configurations for raster Standards (resolution,crs,no_data_val,positive_mask_val,negative_mask_val,country_limits and optionally raster_cache_size)
       """
 
       self.security_limt = 1
@@ -66,8 +72,16 @@ class Raster_Standards:
       grids = self._construct_grids()
       self.xgrid = grids[0]
       self.ygrid = grids[1]
-      self.x_center_point = np.median(self.xgrid)
-      self.y_center_point = np.median(self.ygrid)
+      self.x_center_point = 0.5 * (self.xgrid[0] + self.xgrid[-1]) # grids are evenly spaced, so the median is the midpoint
+      self.y_center_point = 0.5 * (self.ygrid[0] + self.ygrid[-1])
+      self._x0 = self.xgrid[0]
+      self._y0 = self.ygrid[0]
+      self._inv_res_x = 1.0/self.reference_raster.meta['transform'][0]
+      self._inv_res_y = -1.0/self.reference_raster.meta['transform'][4] # the north south pixel size is negative
+      self.raster_cache_size = raster_base_configs.get('raster_cache_size',0)
+      self._raster_cache = OrderedDict() # (path,mtime) -> read only raster array, least recently used first
+      self._raster_cache_lock = threading.Lock()
+      self._validated = set() # paths of the rasters that already passed the verifications
 
   
 
@@ -84,14 +98,29 @@ class Raster_Standards:
       y_min_limit = y_max_limit + ref_aff[4]*ref_heigh
 
 
-      xgrid = np.arange(x_min_limit, x_max_limit,ref_aff[0])
-      ygrid = np.arange(y_min_limit, y_max_limit, ref_aff[0])
+      # One grid value per raster column/row. linspace avoids the float drift arange has with steps like 1/120
+      xgrid = np.linspace(x_min_limit, x_max_limit, ref_width, endpoint=False)
+      ygrid = np.linspace(y_min_limit, y_max_limit, ref_heigh, endpoint=False)
 
 
+      xgrid.setflags(write=False) # the grids are shared by every caller and never change
+      ygrid.setflags(write=False)
       return (xgrid,ygrid)
 
 
     
+  def _get_grid_index(self,values,origin,inv_res,size):
+      """ Index of the values on an evenly spaced grid of the given size, as np.searchsorted gives, from the grid origin and resolution"""
+      position = (values - origin) * inv_res
+      # rounding first makes values lying on a cell boundary always resolve to the same cell
+      return np.clip(np.ceil(np.round(position, 6)).astype(np.int64), 0, size)
+
+  def get_grid_indexes(self,Long,Lat):
+      """ Returns the xgrid and ygrid indexes of the coordinates straight from the grid origin and resolution. They match np.searchsorted except for coordinates on a cell boundary, which resolve consistently to the cell they start"""
+      ix = self._get_grid_index(Long,self._x0,self._inv_res_x,self.reference_raster.width)
+      iy = self._get_grid_index(Lat,self._y0,self._inv_res_y,self.reference_raster.height)
+      return ix,iy
+
   def _reescale(self,raster_array,raster_object):
       """ Reescale a raster array on the desired resolution """
       if not (round(self.resolution,5) == round(raster_object.meta['transform'][0],5)):
@@ -123,10 +152,12 @@ class Raster_Standards:
     """ Get a portion form a raster array based on the country limits"""
     col_start, row_start = ~aff * (self.x_min_limit, self.y_max_limit)
     col_stop, row_stop = ~aff * (self.x_max_limit, self.y_min_limit)
-    return ((int(row_start), int(row_stop)), (int(col_start), int(col_stop)))
+    return Window(col_off=int(col_start), row_off=int(row_start), width=int(col_stop)-int(col_start), height=int(row_stop)-int(row_start))
 
-  def _read_array_standarized(self,raster,raster_name):
-      """ Performs verifications and standarizations for raster arrays """
+  def _validate_raster(self,raster):
+      """ Performs the verifications a raster must pass before being read. Each path is verified only once """
+      if raster.name in self._validated:
+        return
 
       #1 Check if orientaion from Affine position 4 is negative
       res_n_s = raster.meta['transform'][4]
@@ -145,64 +176,121 @@ class Raster_Standards:
         raise Exception("Sorry,crs from this raster is no EPSG:4326")
         # raster = raster.to_crs(epsg=self.crs)
 
-      #4 Extracting only the window from Raster Standars Object
-      raster_array = raster.read(1)
-
-
-      #5 Resampling
+      #4 Resampling
       if not (round(self.reference_raster.meta['transform'][0],5) == round(raster.meta['transform'][0],5)):
          raise Exception(f"Files are not on the same resolution. That should be {round(self.reference_raster.meta['transform'][0],5)}")
       
-      #6 converting nodata value if necessary
+      #5 converting nodata value if necessary
       if raster.nodata != self.no_data_val:
         raise Exception(f"Raster dont have default no data val. That should be {self.no_data_val}")
 
+      self._validated.add(raster.name)
 
-      #6 converting nodata value if necessary
-      if raster.nodata != self.no_data_val:
-        raise Exception(f"Raster dont have default no data val. That should be {self.no_data_val}")
-        
+  def prevalidate_directory(self,dir_path):
+      """ Verifies all the .tif files on a directory at once, so later reads skip the verifications """
+      for filepath in self.get_raster_paths_from_dir(dir_path):
+        with rasterio.open(filepath) as raster:
+          self._validate_raster(raster)
 
-      #7 Asserting that numpy array will be float32
-      if raster.meta['dtype'] != self.reference_raster.meta['dtype']:
-        raise Exception(f"Raster dont have default dtype. That should be {self.reference_raster.meta['dtype']}")
-      
-      #8 Setting raster to none. The information that matters is the rater aray
+  def _read_array_standarized(self,raster,raster_name,window=None):
+      """ Performs verifications and standarizations for raster arrays. If a window is given only that portion is read """
+
+      self._validate_raster(raster)
+
+      #Extracting the raster, or only the requested window of it, always as float32
+      raster_array = raster.read(1,window=window,out_dtype=np.float32)
+
+      #Setting raster to none. The information that matters is the rater aray
       raster = None
 
       return raster_array
   
+  def open_raster_standarized(self,path):
+      """ Returns the opened raster after its verifications, to be sampled without being read """
+      raster = rasterio.open(path)
+      self._validate_raster(raster)
+      return raster
+
+  def sample_raster_cells(self,raster,rows,cols):
+      """ Returns the raster values on the given cells. Cells are visited on block order, so each block is decompressed once and reused from GDAL cache"""
+      block_rows,block_cols = raster.block_shapes[0]
+      order = np.lexsort((cols//block_cols, rows//block_rows))
+      xs,ys = raster.xy(rows[order], cols[order])
+      values = np.empty(len(order), dtype=np.float32)
+      values[order] = np.fromiter((value[0] for value in raster.sample(zip(xs,ys),indexes=1)), dtype=np.float32, count=len(order))
+      return values
+
   def get_land_reference_array_mask(self,land_reference_path):
-      """ Returns the reference array mask conseidering scales and limits"""
+      """ Returns the reference array mask conseidering scales and limits. It is cached on a .npy file next to the raster, named after the limits and resolution, and memory mapped afterwards"""
+      settings = repr((self.x_min_limit,self.x_max_limit,self.y_min_limit,self.y_max_limit,self.resolution))
+      cache_path = os.path.splitext(land_reference_path)[0] + '_mask_' + hashlib.md5(settings.encode()).hexdigest()[:12] + '.npy'
+      if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(land_reference_path):
+        return np.load(cache_path, mmap_mode='r')
+
       raster = rasterio.open(land_reference_path)
       raster_array = raster.read(1,window = self._get_window_from_extent(raster.meta['transform']))
       raster_array,_ = self._reescale(raster_array,raster)
-      return raster_array
 
-  def get_raster_array(self,path,print_example = False):
-      """ Returns a raster array with all the standarizations applied"""
-      #openning raster
-      raster = rasterio.open(path)
-      #get standarized raster array
-      raster_array = self._read_array_standarized(raster,path.split("/")[-1])   
+      # the cache is written aside and moved into place, so an interrupted write never leaves a truncated file behind
+      tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+      try:
+        with open(tmp_path,'wb') as f:
+          np.save(f, raster_array)
+        os.replace(tmp_path, cache_path)
+      except OSError as e:
+        print(f"The land reference mask could not be cached on {cache_path}: {e}")
+        if os.path.exists(tmp_path):
+          os.remove(tmp_path)
+        return raster_array
+      # the same read only memory map is returned whether the cache was hit or just written
+      return np.load(cache_path, mmap_mode='r')
+
+  def get_raster_array(self,path,print_example = False,window=None):
+      """ Returns a raster array with all the standarizations applied. If a window is given only that portion is read. Cached arrays are read only"""
+      if not self.raster_cache_size:
+        #openning raster
+        raster = rasterio.open(path)
+        #get standarized raster array
+        raster_array = self._read_array_standarized(raster,path.split("/")[-1],window=window)   
+        return raster_array
+
+      # the whole raster is cached, so later calls with any window are served from memory
+      key = (path,os.path.getmtime(path))
+      with self._raster_cache_lock:
+        raster_array = self._raster_cache.get(key)
+        if raster_array is not None:
+          self._raster_cache.move_to_end(key)
+      if raster_array is None:
+        raster_array = self._read_array_standarized(rasterio.open(path),path.split("/")[-1])
+        raster_array.setflags(write=False)
+        with self._raster_cache_lock:
+          self._raster_cache[key] = raster_array
+          while len(self._raster_cache) > self.raster_cache_size:
+            self._raster_cache.popitem(last=False)
+      if window is not None:
+        raster_array = raster_array[window.toslices()]
       return raster_array
     
-  def get_rasters_from_dir(self,dir_path):
-      """ Read all the .tif files on the standarized format and stack them"""
-      rasters = []
-      for (dirpath, dirnames, filenames) in os.walk(dir_path):
-        dir_files_paths_list = sorted([os.path.join(dir_path, fname) for fname in filenames])
-        for filepath,filename in zip(dir_files_paths_list,filenames):
-          if filename.endswith('.tif'):
-            raster_array  = self.get_raster_array(filepath)
-            rasters.append(raster_array) 
-            del raster_array
-        break
-      
-      result =  np.stack([value for value in rasters])
-      del rasters
+  def get_raster_paths_from_dir(self,dir_path):
+      """ Returns the sorted paths of the .tif files on a directory"""
+      if not os.path.isdir(dir_path):
+        raise FileNotFoundError(f"Raster directory {dir_path} does not exist")
+      with os.scandir(dir_path) as entries:
+        return sorted(entry.path for entry in entries if entry.name.endswith('.tif') and entry.is_file())
+
+  def get_rasters_from_dir(self,dir_path,out=None):
+      """ Read all the .tif files on the standarized format and stack them. If out is given the rasters are written straight into it"""
+      filepaths = self.get_raster_paths_from_dir(dir_path)
+      with rasterio.Env(GDAL_CACHEMAX=512):
+        for i,filepath in enumerate(filepaths):
+          raster_array  = self.get_raster_array(filepath)
+          if out is None:
+            # the first raster gives the shape shared by all of them, so the stack is allocated once
+            out = np.empty((len(filepaths),)+raster_array.shape, dtype=np.float32)
+          out[i] = raster_array
+          del raster_array
 
-      return result
+      return out
 
   def get_land_reference_array_infos(self,country_mask_reference):
       """ Returns infos (raster_array,xgrid,ygrid) from a contry mask reference array"""
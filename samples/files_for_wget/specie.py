@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import os
 import geopandas as gpd
@@ -33,6 +35,10 @@ class Specie:
        GBIF base URL
   _out_shapefile_parent_folder : string
       Path with shapefiles saving location
+  _max_workers : int
+      Number of GBIF pages requested concurrently
+  _session : requests.Session
+      HTTP session reusing connections among requests
 
   """
   def __init__(self,
@@ -46,7 +52,8 @@ class Specie:
                dropDuplicates:bool=True,
                tryOverrideSpecieData:bool=False,
                base_url:str = "http://api.gbif.org/v1/occurrence/search",
-               out_shapefile_parent_folder:str = "/content/drive/My Drive/TFC_MatheusSasso/Data/GBIF_Ocurrences"):
+               out_shapefile_parent_folder:str = "/content/drive/My Drive/TFC_MatheusSasso/Data/GBIF_Ocurrences",
+               max_workers:int = 8):
     
     """    
     Parameters
@@ -58,7 +65,7 @@ class Specie:
     countryObj : object
         Object with country shapefiles
     limit : int
-        Limit of occurences in one request 
+        Limit of occurences in one request (GBIF serves at most 300)
     hasCoordinate : bool
         True for only get occurences with coordinates
     lowYear : int
@@ -73,6 +80,8 @@ class Specie:
         GBIF base URL
     out_shapefile_parent_folder : str
         Path with shapefiles saving location
+    max_workers : int
+        Number of GBIF pages requested concurrently
         
     """
     
@@ -82,7 +91,7 @@ class Specie:
     #--------Parameters
     self._taxonKey = taxonKey
     self._species_name = species_name
-    self._limit = limit
+    self._limit = min(limit,300) # GBIF never returns more than 300 records per page, so a bigger stride would skip records
     self._hasCoordinate = hasCoordinate
     self._lowYear = lowYear
     self._upYear = upYear
@@ -91,6 +100,13 @@ class Specie:
     self._tryOverrideSpecieData = tryOverrideSpecieData
     self._base_url = base_url
     self._out_shapefile_parent_folder = out_shapefile_parent_folder
+    self._max_workers = max_workers
+
+    #--------HTTP Session
+    self._session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=2*max_workers)
+    self._session.mount('http://', adapter)
+    self._session.mount('https://', adapter)
 
     #--------Data Retrieval
     if (not self._tryOverrideSpecieData) and (self._data_reader()):
@@ -110,15 +126,22 @@ class Specie:
   def _managing_complete_species_dataframe(self):
     """ Organizes GBIF information in a dataframe considering offsets and some basic data cleaning"""
 
-    df = pd.DataFrame(columns=['SCIENTIFIC_NAME','LONGITUDE','LATITUDE','COUNTRY','STATE_PROVINCE','IDENTIFICATION_DATE','DAY','MONTH','YEAR'])
-    endOfRecords = False  
-    offset = 0  
-    status = 200
+    rows = []
     params = {'taxonKey': str(self._taxonKey) ,'limit':self._limit,'hasCoordinate':self._hasCoordinate,'year':self._year_range,'country':'BR'} 
-    while endOfRecords == False and status == 200:  
-        r, endOfRecords, status = self._gbif_request_json_request(offset, params)
-        df = self._create_specie_dataframe(df,r)
-        offset = len(df) + 1
+    r, endOfRecords, status = self._gbif_request_json_request(0, dict(params))
+    if status == 200:
+        rows.extend(r['results'])
+        if not endOfRecords:
+            # The first page tells how many occurrences exist, so the remaining pages are requested concurrently.
+            # GBIF rejects requests with offset+limit above 100000, so the last page is shortened and nothing beyond is asked
+            max_records = 100000
+            offsets = range(self._limit, min(r['count'], max_records), self._limit)
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                pages = list(executor.map(lambda offset: self._gbif_request_json_request(offset, dict(params, limit=min(self._limit, max_records-offset))), offsets))
+            for r, _, status in pages:
+                if status == 200:
+                    rows.extend(r['results'])
+    df = self._create_specie_dataframe(rows)
     
     # Double check to certify there is no empty lat/long data
     df = df[pd.notnull(df['LATITUDE'])]
@@ -136,7 +159,7 @@ class Specie:
 
     query = self._base_url
     params['offset'] = offset
-    r = requests.get(query,params=params)
+    r = self._session.get(query,params=params)
     status_code =  r.status_code
     if r.status_code != 200:  
         print(f"API call failed at offset {offset} with a status code of {r.status_code}.") 
@@ -170,32 +193,21 @@ class Specie:
     #saving shapefile data inside the created folder
     self._gdf.to_file(species_folder)
   
-  def _refact_dict(self, result):
-    """ Refact dict placing None in empty cells """
-
-    columns = result.keys()
-    desired_columns = ['scientificName','decimalLongitude','decimalLatitude','country','stateProvince','eventDate','day','month','year','occurrenceRemarks']
-    for d_col in desired_columns:
-      if d_col not in columns:
-        result[d_col] = None
-    return result
-
-  def _create_specie_dataframe(self,df_final,request):
-    """ Create species dataframe with the request data """
-
-    for result in request['results']:
-      result = self._refact_dict(result)
-      df_final = df_final.append({
-          "SCIENTIFIC_NAME": result['scientificName'],
-          "LONGITUDE": result['decimalLongitude'],
-          "LATITUDE":  result['decimalLatitude'],
-          "COUNTRY":  result['country'],
-          "STATE_PROVINCE":  result['stateProvince'],
-          "IDENTIFICATION_DATE":  result['eventDate'],
-          "DAY":  result['day'],
-          "MONTH":  result['month'],
-          "YEAR":  result['year']}, ignore_index=True)
-    return df_final
+  def _create_specie_dataframe(self,results):
+    """ Create species dataframe with the GBIF results. Missing keys become empty cells """
+
+    columns = {"scientificName": "SCIENTIFIC_NAME",
+               "decimalLongitude": "LONGITUDE",
+               "decimalLatitude": "LATITUDE",
+               "country": "COUNTRY",
+               "stateProvince": "STATE_PROVINCE",
+               "eventDate": "IDENTIFICATION_DATE",
+               "day": "DAY",
+               "month": "MONTH",
+               "year": "YEAR"}
+    df = pd.DataFrame(results, columns=list(columns))
+    df.rename(columns=columns, inplace=True)
+    return df
 
   def _get_inside_country_dataframe(self,df):
     """Use country(brazil) object to double check if points truly are in Brazil"""
@@ -5,11 +5,9 @@ class Utils:
     def __init__(self):
         pass
         
-    def retrieve_data_from_np_array(self,path):
-        """ Read a numpy array"""
-        with open(path, 'rb') as f:
-            np_array = np.load(f)
-        return np_array
+    def retrieve_data_from_np_array(self,path,mode='r'):
+        """ Read a numpy array memory mapped, so only the pages that are used are loaded. Use mode='r+' to modify it on disk"""
+        return np.load(path, mmap_mode=mode)
 
     def create_folder_structure(self,folder):
         """ Create the comple folder structure if it does not exists """
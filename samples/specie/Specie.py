@@ -80,32 +80,21 @@ class Specie:
     output_fp = os.path.join(species_folder, specie_id_file)
     self._gdf.to_file(output_fp)
   
-  def _refact_dict(self, result):
-    columns = result.keys()
-    desired_columns = ['scientificName','decimalLongitude','decimalLatitude','country','stateProvince','eventDate','day','month','year','occurrenceRemarks']
-    for d_col in desired_columns:
-      if d_col not in columns:
-        result[d_col] = None
-    return result
-
   def _create_specie_dataframe(self):
-    df = pd.DataFrame(columns=['SCIENTIFIC_NAME','LONGITUDE','LATITUDE','COUNTRY','STATE_PROVINCE','IDENTIFICATION_DATE','DAY','MONTH','YEAR','OCCURENCE_REMARKS'])
-    for result in self._r['results']:
-      result = self._refact_dict(result)
-      df = df.append({
-          "SCIENTIFIC_NAME": result['scientificName'],
-          "LONGITUDE": result['decimalLongitude'],
-          "LATITUDE":  result['decimalLatitude'],
-          "COUNTRY":  result['country'],
-          "STATE_PROVINCE":  result['stateProvince'],
-          "IDENTIFICATION_DATE":  result['eventDate'],
-          "DAY":  result['day'],
-          "MONTH":  result['month'],
-          "YEAR":  result['year'],
-          "OCCURENCE_REMARKS":  result['occurrenceRemarks']
-          }, ignore_index=True)
-      df = df.drop_duplicates(ignore_index=True) if self._dropDuplicates else df
-      df.sort_values("STATE_PROVINCE", inplace = True,ignore_index=True)
+    columns = {"scientificName": "SCIENTIFIC_NAME",
+               "decimalLongitude": "LONGITUDE",
+               "decimalLatitude": "LATITUDE",
+               "country": "COUNTRY",
+               "stateProvince": "STATE_PROVINCE",
+               "eventDate": "IDENTIFICATION_DATE",
+               "day": "DAY",
+               "month": "MONTH",
+               "year": "YEAR",
+               "occurrenceRemarks": "OCCURENCE_REMARKS"}
+    df = pd.DataFrame(self._r['results'], columns=list(columns))
+    df.rename(columns=columns, inplace=True)
+    df = df.drop_duplicates(ignore_index=True) if self._dropDuplicates else df
+    df.sort_values("STATE_PROVINCE", inplace = True,ignore_index=True)
     return df
 
   def _get_inside_country_dataframe(self,df):